@@ -1,9 +1,26 @@
+import threading
+import time
+from math import degrees
+
 from chimera.instruments.dome import DomeBase
+from chimera.interfaces.dome import Mode
 
 # If dome uses .features() one implementation could be:
 # http://stackoverflow.com/questions/21060073/dynamic-inheritance-in-python
 #
-from chimera_domesync.util.dome_track import AzimuthModel
+from chimera_domesync.util.breaker import CircuitBreaker
+from chimera_domesync.util.cache import StatusCache
+from chimera_domesync.util.dome_track import AzimuthModel, map180, SIDEREAL_RATE
+from chimera_domesync.util.kinematics import DomeKinematics
+
+
+def _degrees(az):
+    # Dome azimuths may come as chimera Coord objects or as plain degrees
+    return float(getattr(az, 'D', az))
+
+
+def _isotime(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t))
 
 
 class DomeSync(DomeBase):
@@ -17,13 +34,94 @@ class DomeSync(DomeBase):
         "mount_dec_height": 0,
         "mount_dec_length": 49.2,
         "mount_dec_offset": 0,
+        'slit_width': None,  # slit width, in the same units as dome_radius; None ignores the slit edges
+        'aperture': 0,  # telescope aperture diameter, in the same units as dome_radius
+        'slit_bottom': 0,  # altitude of the lower end of the slit, in degrees; the dome wall is below it
+        'shutter_top': 100,  # altitude of the upper end of the slit along the slit, in degrees (> 90 past zenith)
+        'vignetting_samples': 16,  # rays traced across the aperture diameter to estimate the vignetting
+        'track': False,  # move the dome with the telescope while it tracks and the dome is in track mode
+        'track_period': 30,  # seconds between dome tracking checks
+        'az_tolerance': 5.0,  # degrees the dome may lag the solved azimuth before it is moved
+        'dome_rate': 2.5,  # initial estimate of the dome rotation rate in degrees per second
+        'kinematics_period': 0.5,  # seconds between dome azimuth samples during a slew
+        'kinematics_smoothing': 0.3,  # weight of the latest slew in the dome rate and acceleration estimates
+        'zenith_limit': 80.0,  # altitude above which the dome point is close to the singular zenith region
+        'zenith_window': 600.0,  # seconds ahead to look for a zenith passage
+        'zenith_step': 10.0,  # sampling step of the zenith passage prediction, in seconds
+        'call_timeout': 10.0,  # deadline, in seconds, for calls to the dome, telescope and site
+        'slew_timeout': 600.0,  # deadline, in seconds, for a dome slew
+        'breaker_threshold': 3,  # consecutive failed calls before an instrument is considered unhealthy
+        'breaker_reset': 30.0,  # seconds to wait before calling an unhealthy instrument again
+        'az_ttl': 1.0,  # seconds getAz answers are served from the status cache
+        'slewing_ttl': 0.5,  # seconds isSlewing answers are served from the status cache
+        'slit_ttl': 5.0,  # seconds isSlitOpen answers are served from the status cache
+        'flap_ttl': 5.0,  # seconds isFlapOpen answers are served from the status cache
     }
 
+    # Dome events used to keep the status cache up to date and their handlers
+    _events = {'slewBegin': '_domeSlewBegin', 'slewComplete': '_domeSlewComplete',
+               'abortComplete': '_domeAbortComplete', 'slitOpened': '_domeSlitOpened',
+               'slitClosed': '_domeSlitClosed', 'flapOpened': '_domeFlapOpened', 'flapClosed': '_domeFlapClosed'}
+
     def __start__(self):
-        self.setHz(1.0 / 30.0)
-        self._DomeModel = AzimuthModel(self._getSite()['latitude'], self['dome_radius'], self['mount_dec_height'],
-                                       self['mount_dec_length'], self['mount_dec_offset'])
-        print 'latitude', self._getSite()['latitude'].R
+        self.setHz(1.0 / self['track_period'])
+        self._breakers = dict((name, CircuitBreaker(name, self['call_timeout'], self['breaker_threshold'],
+                                                    self['breaker_reset']))
+                              for name in ('dome', 'telescope', 'site'))
+        self._cache = StatusCache({'getAz': self['az_ttl'], 'isSlewing': self['slewing_ttl'],
+                                   'isSlitOpen': self['slit_ttl'], 'isFlapOpen': self['flap_ttl']})
+        self._kinematics = DomeKinematics(self['dome_rate'], smoothing=self['kinematics_smoothing'])
+        self._lastSlew = None
+        self._slewLock = threading.Lock()
+        self._zenithHold = None
+        self._trackState = None
+        self._DomeModel = AzimuthModel(self._getSite()['latitude'].D, self['dome_radius'], self['mount_dec_height'],
+                                       self['mount_dec_length'], self['mount_dec_offset'],
+                                       slit_width=self['slit_width'], aperture=self['aperture'],
+                                       slit_bottom=self['slit_bottom'], shutter_top=self['shutter_top'])
+        self.log.debug('Site latitude: %s' % self._DomeModel.site_latitude)
+        self._connectEvents()
+
+    def __stop__(self):
+        self._connectEvents(connect=False)
+
+    def _connectEvents(self, connect=True):
+        # Not every dome driver publishes every event, the cache falls back to its time-to-live for the missing ones
+        dome = self._getDome()
+        proxy = self.getProxy()
+        for event, handler in self._events.items():
+            try:
+                dome_event = getattr(dome, event)
+                if connect:
+                    dome_event += getattr(proxy, handler)
+                else:
+                    dome_event -= getattr(proxy, handler)
+            except Exception as e:
+                self.log.debug('Could not %s dome event %s: %s' % ('connect' if connect else 'disconnect', event, e))
+
+    def _domeSlewBegin(self, position):
+        self._cache.invalidate('getAz')
+        self._cache.set('isSlewing', True)
+
+    def _domeSlewComplete(self, position, status):
+        self._cache.set('getAz', position)
+        self._cache.set('isSlewing', False)
+
+    def _domeAbortComplete(self, position):
+        self._cache.set('getAz', position)
+        self._cache.set('isSlewing', False)
+
+    def _domeSlitOpened(self, az):
+        self._cache.set('isSlitOpen', True)
+
+    def _domeSlitClosed(self, az):
+        self._cache.set('isSlitOpen', False)
+
+    def _domeFlapOpened(self, az):
+        self._cache.set('isFlapOpen', True)
+
+    def _domeFlapClosed(self, az):
+        self._cache.set('isFlapOpen', False)
 
     def _getSite(self):
         return self.getManager().getProxy(self["site"], lazy=True)
@@ -37,43 +135,291 @@ class DomeSync(DomeBase):
     def _getTelescope(self):
         return self.getManager().getProxy(self["telescope"], lazy=True)
 
+    def _call(self, target, method, *args, **kwargs):
+        # Call method on the dome, telescope or site through its circuit breaker
+        getter = {'dome': self._getDome, 'telescope': self._getTelescope, 'site': self._getSite}[target]
+        probe = kwargs.get('probe')
+        return self._breakers[target].call(lambda: getattr(getter(), method)(*args), kwargs.get('timeout'),
+                                           probe=probe and (lambda: getattr(getter(), probe)()))
+
+    def _query(self, method, last_known=True):
+        # Query the dome through the status cache, serving the last known answer while the dome does not respond
+        # unless last_known is False
+        try:
+            return self._cache.get(method)
+        except KeyError:
+            pass
+
+        try:
+            value = self._call('dome', method)
+        except Exception as e:
+            if not last_known:
+                raise
+            try:
+                value = self._cache.last(method)
+            except KeyError:
+                raise e
+            self.log.warning('Dome %s failed (%s), using the last known value.' % (method, e))
+            return value
+        self._cache.set(method, value)
+        return value
+
+    def _command(self, method, invalidates, *args, **kwargs):
+        # Send a command to the dome, dropping the cached answers it makes stale before and after it runs.
+        # Long commands check an unhealthy dome with a quick getAz first, rather than being the trial call themselves.
+        if 'timeout' in kwargs:
+            kwargs['probe'] = 'getAz'
+        self._cache.invalidate(*invalidates)
+        try:
+            return self._call('dome', method, *args, **kwargs)
+        finally:
+            self._cache.invalidate(*invalidates)
+
+    def getBreakerStatus(self):
+        return dict((name, breaker.status()) for name, breaker in self._breakers.items())
+
+    def _slewDome(self, az):
+        # Slew the dome while sampling its azimuth to keep the kinematics model up to date. The tracking loop and the
+        # clients may slew at the same time: one slew runs at a time, and it ends when its sampler is done with it.
+        with self._slewLock:
+            done = threading.Event()
+            self._kinematics.begin_slew(time.time(), _degrees(self._call('dome', 'getAz')))
+            sampler = threading.Thread(target=self._sampleSlew, args=(done,))
+            sampler.daemon = True
+            sampler.start()
+            try:
+                return self._command('slewToAz', ('getAz', 'isSlewing'), az, timeout=self['slew_timeout'])
+            finally:
+                done.set()
+                sampler.join()
+                self._lastSlew = time.time()
+
+    def _sampleSlew(self, done):
+        deadline = time.time() + self['slew_timeout']
+        try:
+            while time.time() < deadline:
+                start = time.time()
+                az = _degrees(self._call('dome', 'getAz'))
+                self._kinematics.add_sample((start + time.time()) / 2., az)
+                # some drivers return from slewToAz before the dome stops
+                if done.is_set() and not self._call('dome', 'isSlewing'):
+                    break
+                time.sleep(self['kinematics_period'])
+        except Exception as e:
+            self.log.debug('Stopped sampling the dome slew: %s' % e)
+        finally:
+            self._kinematics.end_slew()
+
+    def _pointing(self):
+        # Hour angle and declination of the telescope, in radians
+        position = self._call('telescope', 'getPositionRaDec')
+        lst = self._call('site', 'LST_inRads')
+        return lst - position.ra.R, position.dec.R
+
+    def _leadTarget(self, ha, dec, current):
+        # Aim at the solved azimuth half a tracking period after the dome is expected to arrive, so that the dome
+        # is as much ahead of the telescope after the slew as it will lag behind it before the next one.
+        target = self._DomeModel.solve_dome_azimuth(ha, dec)
+        for i in range(3):
+            lead = self._kinematics.slew_time(map180(target - current)) + self['track_period'] / 2.
+            target = self._DomeModel.solve_dome_azimuth(ha + lead * SIDEREAL_RATE, dec)
+        return target
+
+    def getKinematics(self):
+        return self._kinematics.status()
+
+    def estimateSlewTime(self, az=None):
+        """
+        Estimate how many seconds the dome takes to reach az (in degrees), or the azimuth solved for the current
+        telescope position if az is None.
+        """
+        current = _degrees(self._query('getAz'))
+        if az is None:
+            az = self._DomeModel.solve_dome_azimuth(*self._pointing())
+        return self._kinematics.slew_time(map180(az - current))
+
     def _getDomeAz(self, az):
-        return self._DomeModel.solve_dome_azimuth(self._getTelescope().getPositionRaDec(),
-                                                  lst=self._getSite().LST_inRads())
+        ha, dec = self._pointing()
+        return self._leadTarget(ha, dec, _degrees(self._query('getAz')))
 
     def _getDomeAzSynced(self, dome_az):
         az = dome_az  # TODO:
         return az
 
+    def control(self):
+        try:
+            self._track()
+        except Exception:
+            self.log.exception('Error while tracking the dome.')
+            # the last snapshot may claim a dome that is no longer aligned: take a new one or drop it
+            try:
+                self._updateTrackState(*self._pointing())
+            except Exception as e:
+                self.log.warning('Could not update the dome synchronisation state: %s' % e)
+                self._trackState = None
+        return True
+
+    def _track(self):
+        # The synchronisation snapshot is kept up to date even while the dome is not moved
+        ha, dec = self._pointing()
+        if self['track'] and self._following():
+            last_slew = self._lastSlew
+            self._trackDome(ha, dec, _degrees(self._query('getAz')))
+            if self._lastSlew != last_slew:
+                # the slew took a while, snapshot the telescope where it is now rather than where it was before it
+                ha, dec = self._pointing()
+        else:
+            self._zenithHold = None
+        self._updateTrackState(ha, dec)
+
+    def _following(self):
+        # Move the dome only while the telescope tracks and the dome is in track mode, so that a parked or stopped
+        # telescope and a dome set to stand, e.g. to be moved by hand, are left alone
+        if self._call('dome', 'getMode') != Mode.Track:
+            self.log.debug('Dome is not in track mode, not moving it.')
+            return False
+        if not self._call('telescope', 'isTracking'):
+            self.log.debug('Telescope is not tracking, not moving the dome.')
+            return False
+        return True
+
+    def _zenithHolding(self, ha, dec):
+        # Whether a zenith hold is in force: it lasts until the end of its passage, unless the telescope moved away
+        hold = self._zenithHold
+        if hold is None:
+            return False
+        now = time.time()
+        expected_ha = hold['ha'] + (now - hold['time']) * SIDEREAL_RATE
+        moved = abs(map180(degrees(ha - expected_ha))) > self['az_tolerance'] or \
+            abs(degrees(dec - hold['dec'])) > self['az_tolerance']
+        if now >= hold['end'] or moved:
+            self.log.debug('Zenith passage over, releasing the dome hold.')
+            self._zenithHold = None
+            return False
+        return True
+
+    def _trackDome(self, ha, dec, current):
+        # Close to the zenith the dome azimuth may change faster than the tracking loop can follow, i.e. by more than
+        # az_tolerance in a track_period. Instead of chasing it, park the dome in the middle of the fast part of the
+        # passage just before it starts and hold it there, without recomputing it, until the passage is over.
+        if not self._zenithHolding(ha, dec):
+            passage = self._DomeModel.zenith_passage(ha, dec, self['zenith_window'], self['zenith_step'],
+                                                     self['zenith_limit'],
+                                                     follow_rate=self['az_tolerance'] / float(self['track_period']))
+            if passage.singular:
+                lead = self._kinematics.slew_time(map180(passage.center_az - current)) + self['track_period']
+                if passage.start_time <= lead:
+                    now = time.time()
+                    self._zenithHold = {'center': passage.center_az,
+                                        'tolerance': passage.half_width + self['az_tolerance'],
+                                        'end': now + passage.end_time, 'time': now, 'ha': ha, 'dec': dec}
+                    self.log.debug('Zenith passage: peak rate %.2f deg/s, holding dome at %.2f +/- %.2f deg for '
+                                   '%.0f s' % (passage.peak_rate, passage.center_az, self._zenithHold['tolerance'],
+                                               passage.end_time))
+
+        hold = self._zenithHold
+        if hold is not None:
+            if abs(map180(hold['center'] - current)) > hold['tolerance']:
+                self._slewDome(hold['center'])
+            return
+
+        target = self._DomeModel.solve_dome_azimuth(ha, dec)
+        if abs(map180(target - current)) > self['az_tolerance']:
+            self._slewDome(self._leadTarget(ha, dec, current))
+
+    def _updateTrackState(self, ha, dec):
+        # Snapshot of the synchronisation, so that getMetadata does not need to ask the instruments again. It must
+        # show the dome as it is, not its last known azimuth.
+        actual = _degrees(self._query('getAz', last_known=False))
+        solved, window = [float(v) for v in self._DomeModel.solve_dome_azimuth_batch(ha, dec)]
+        error = map180(actual - solved)
+        self._trackState = {
+            'time': time.time(),
+            'solved_az': solved,
+            'actual_az': actual,
+            'error': error,
+            'margin': None if window != window else window - abs(error),  # window is NaN without a slit width
+            'vignetting': self._DomeModel.vignetting(ha, dec, actual, self['vignetting_samples']).total
+            if self._DomeModel.slit_configured else None,
+            'last_slew': self._lastSlew,
+        }
+
+    def getTrackState(self):
+        """
+        Last synchronisation state seen by the tracking loop: solved and actual dome azimuths, tracking error and
+        slit window margin (in degrees, the margin is None without slit_width), vignetted fraction of the aperture
+        (None without slit_width and aperture) and the times of the snapshot and of the last slew (as UNIX times).
+        None before the first tracking check and after a check that could not read the dome.
+        """
+        return None if self._trackState is None else dict(self._trackState)
+
     def slewToAz(self, az):
-        return self._getDome().slewToAz(self._getDomeAz(az))
+        return self._slewDome(self._getDomeAz(az))
 
     def isSlewing(self):
-        return self._getDome().isSlewing()
+        return self._query('isSlewing')
 
     def abortSlew(self):
-        return self.abortSlew()
+        return self._command('abortSlew', ('getAz', 'isSlewing'))
 
     def getAz(self):
-        return self._getDomeAzSynced(self._getDome().getAz())
+        return self._getDomeAzSynced(self._query('getAz'))
 
     def openSlit(self):
-        return self._getDome().openSlit()
+        return self._command('openSlit', ('isSlitOpen',), timeout=self['slew_timeout'])
 
     def closeSlit(self):
-        return self._getDome().closeSlit()
+        return self._command('closeSlit', ('isSlitOpen',), timeout=self['slew_timeout'])
 
     def isSlitOpen(self):
-        return self._getDome().isSlitOpen()
+        return self._query('isSlitOpen')
 
     def openFlap(self):
-        return self._getDome().openFlap()
+        return self._command('openFlap', ('isFlapOpen',), timeout=self['slew_timeout'])
 
     def closeFlap(self):
-        return self._getDome().closeFlap()
+        return self._command('closeFlap', ('isFlapOpen',), timeout=self['slew_timeout'])
 
     def isFlapOpen(self):
-        return self._getDome().isFlapOpen()
+        return self._query('isFlapOpen')
+
+    def getVignetting(self):
+        """
+        Fractions of the telescope aperture vignetted by the dome at its current azimuth, see
+        AzimuthModel.vignetting_batch. None when slit_width and aperture are not configured.
+        """
+        if not self._DomeModel.slit_configured:
+            return None
+        ha, dec = self._pointing()
+        vignetting = self._DomeModel.vignetting(ha, dec, _degrees(self._query('getAz')), self['vignetting_samples'])
+        return dict(vignetting._asdict())
 
     def getMetadata(self, request):
-        return self._getDome().getMetadata(request)
+        try:
+            metadata = list(self._call('dome', 'getMetadata', request))
+        except Exception as e:
+            # still write the synchronisation state, it needs no call to the dome
+            self.log.warning('Could not get the dome metadata: %s' % e)
+            metadata = []
+
+        state = self._trackState
+        if state is None:
+            return metadata
+        if time.time() - state['time'] > 2 * self['track_period']:
+            self.log.warning('Dome synchronisation state is out of date, not adding it to the metadata.')
+            return metadata
+
+        metadata += [
+            ('DSYNC_T', _isotime(state['time']), 'UT time of the dome synchronisation state'),
+            ('DSYNCAZ', round(state['solved_az'], 2), 'Dome azimuth solved for the telescope [deg]'),
+            ('DSACTAZ', round(state['actual_az'], 2), 'Actual dome azimuth [deg]'),
+            ('DSERROR', round(state['error'], 2), 'Dome tracking error [deg]'),
+        ]
+        if state['margin'] is not None:
+            metadata.append(('DSMARGIN', round(state['margin'], 2), 'Slit window margin [deg]'))
+        if state['last_slew'] is not None:
+            metadata.append(('DSLSLEW', _isotime(state['last_slew']), 'UT time of the last dome slew'))
+        if state['vignetting'] is not None:
+            metadata.append(('DOMEVIGN', round(state['vignetting'], 4),
+                             'Fraction of the aperture vignetted by the dome'))
+        return metadata
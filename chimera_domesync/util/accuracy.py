@@ -0,0 +1,114 @@
+# Compare the fast dome azimuth solvers against a high-precision reference over the whole sky.
+#
+# Every fast path is run on a grid of hour angles and declinations covering the sky above the horizon, for several
+# dome geometries in both hemispheres, and its error against solve_dome_azimuth with many iterations is summarised
+# by its maximum and percentiles. New solver variants are checked by adding them to FAST_PATHS.
+
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from chimera_domesync.util.dome_track import AzimuthModel, GEOMETRIES, equatorial_to_horizontal, map180
+
+# Legacy dome_track script sites, in degrees: Moore Observatory and Mt. Kent Observatory
+LATITUDES = {'north': 38.3334, 'south': -27.797778}
+
+# Dome geometries checked, (dome_radius, mount_dec_height, mount_dec_length, mount_dec_offset): the legacy script
+# presets and the DomeSync defaults
+ACCURACY_GEOMETRIES = dict(GEOMETRIES, DomeSync=(147., 0., 49.2, 0.))
+
+PERCENTILES = (50., 90., 99., 99.9)
+
+REFERENCE_LOOPS = 200
+
+# Solvers checked, with their default settings: name -> function(model, ha, dec) returning dome azimuths, in degrees
+FAST_PATHS = {
+    'scalar': lambda model, ha, dec: [model.solve_dome_azimuth(h, d) for h, d in zip(ha, dec)],
+    'batch': lambda model, ha, dec: model.solve_dome_azimuth_batch(ha, dec)[0],
+    'closed': lambda model, ha, dec: model.solve_dome_azimuth_closed_batch(ha, dec)[0],
+}
+
+
+def sky_grid(latitude, step=1.):
+    """
+    Hour angles and declinations, in radians, of a grid with step degrees covering the sky above the horizon.
+    """
+    ha, dec = np.meshgrid(np.radians(np.arange(-180., 180., step)), np.radians(np.arange(-90., 90. + step / 2, step)))
+    ha, dec = ha.ravel(), dec.ravel()
+    az, alt = equatorial_to_horizontal(ha, dec, np.radians(latitude))
+    return ha[alt > 0], dec[alt > 0]
+
+
+def reference(model, ha, dec):
+    """
+    Reference dome azimuths: the legacy iteration run to convergence. The scalar solve_dome_azimuth is checked
+    against its vectorized version on a sample of the points, so that the reference is the scalar algorithm.
+    """
+    azimuths = model.solve_dome_azimuth_batch(ha, dec, nloops=REFERENCE_LOOPS)[0]
+    sample = np.linspace(0, len(ha) - 1, min(len(ha), 200)).astype(int)
+    scalar = np.array([model.solve_dome_azimuth(ha[i], dec[i], nloops=REFERENCE_LOOPS) for i in sample])
+    mismatch = np.abs(map180(scalar - azimuths[sample])).max()
+    if mismatch > 1e-9:
+        raise AssertionError('vectorized reference differs from solve_dome_azimuth by %g deg' % mismatch)
+    return azimuths
+
+
+def error_stats(errors):
+    stats = dict(('p%g' % p, v) for p, v in zip(PERCENTILES, np.percentile(errors, PERCENTILES)))
+    stats['max'] = errors.max()
+    return stats
+
+
+def compare(fast_paths=None, geometries=None, latitudes=None, step=1.):
+    """
+    Run every fast path against the reference for every geometry and latitude.
+
+    :return: list of (geometry, hemisphere, path, stats, seconds) with stats the error maximum and percentiles,
+        in degrees, and seconds the time the fast path took.
+    """
+    fast_paths = fast_paths or FAST_PATHS
+    geometries = geometries or ACCURACY_GEOMETRIES
+    latitudes = latitudes or LATITUDES
+
+    results = []
+    for geometry in sorted(geometries):
+        for hemisphere in sorted(latitudes):
+            model = AzimuthModel(latitudes[hemisphere], *geometries[geometry])
+            ha, dec = sky_grid(latitudes[hemisphere], step)
+            expected = reference(model, ha, dec)
+            for path in sorted(fast_paths):
+                start = time.time()
+                azimuths = fast_paths[path](model, ha, dec)
+                elapsed = time.time() - start
+                errors = np.abs(map180(np.asarray(azimuths) - expected))
+                results.append((geometry, hemisphere, path, error_stats(errors), elapsed))
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Check the fast dome azimuth solvers against the reference.')
+    parser.add_argument('--step', type=float, default=1., help='sky grid step, in degrees')
+    parser.add_argument('--max-error', type=float, default=1e-3,
+                        help='largest error allowed, in degrees (default: %(default)s)')
+    args = parser.parse_args(args)
+
+    columns = ['max'] + ['p%g' % p for p in PERCENTILES]
+    print('%-10s %-6s %-8s ' % ('geometry', 'hemi', 'path') + ' '.join('%10s' % c for c in columns) + '  time [s]')
+
+    failed = False
+    for geometry, hemisphere, path, stats, elapsed in compare(step=args.step):
+        failed |= stats['max'] > args.max_error
+        print('%-10s %-6s %-8s ' % (geometry, hemisphere, path) +
+              ' '.join('%10.3g' % stats[c] for c in columns) + '  %8.3f' % elapsed)
+
+    if failed:
+        print('Some fast paths are off by more than %g deg.' % args.max_error, file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
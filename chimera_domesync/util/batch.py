@@ -0,0 +1,150 @@
+# Compute dome azimuths and slit windows for a catalog of pointings.
+#
+# The catalog is read and solved in chunks by a pool of worker processes, and the results are written out in input
+# order as soon as each chunk is done, so only a few chunks are held in memory at any time.
+
+import argparse
+import csv
+import sys
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from chimera_domesync.util.dome_track import AzimuthModel, GEOMETRIES, local_sidereal_time
+
+OUTPUT_COLUMNS = ['ra', 'dec', 'lst', 'ha', 'dome_az', 'slit_window']
+
+_model = None
+
+
+def _init_worker(model):
+    global _model
+    _model = model
+
+
+def _solve_chunk(chunk):
+    ra, dec, lst = chunk
+    ha = (lst - np.radians(ra)) % (2 * np.pi)
+    dome_az, window = _model.solve_dome_azimuth_batch(ha, np.radians(dec))
+    return np.column_stack([ra, dec, np.degrees(lst) / 15., np.degrees(ha) / 15., dome_az, window])
+
+
+def _to_chunk(ra, dec, time, time_column, longitude):
+    ra, dec, time = [np.asarray(c, dtype=float) for c in (ra, dec, time)]
+    lst = np.radians(time * 15.) if time_column == 'lst' else local_sidereal_time(time, longitude)
+    return ra, dec, lst
+
+
+def read_csv(fp, chunk_size, longitude):
+    """
+    Read a CSV catalog with a header line and the columns ``ra`` and ``dec`` (in degrees) and either ``jd`` (Julian
+    date) or ``lst`` (local sidereal time, in hours).
+    """
+    reader = csv.reader(fp)
+    header = [name.strip().lower() for name in next(reader)]
+    time_column = 'lst' if 'lst' in header else 'jd'
+    columns = [header.index(name) for name in ('ra', 'dec', time_column)]
+
+    rows = []
+    for row in reader:
+        if not row:
+            continue
+        rows.append([row[i] for i in columns])
+        if len(rows) == chunk_size:
+            yield _to_chunk(*(list(zip(*rows)) + [time_column, longitude]))
+            rows = []
+    if rows:
+        yield _to_chunk(*(list(zip(*rows)) + [time_column, longitude]))
+
+
+def read_npy(filename, chunk_size, longitude):
+    """
+    Read a NumPy catalog. It is either a structured array with the fields ``ra``, ``dec`` and ``jd`` or ``lst``, or a
+    (N, 3) array with ra, dec and jd columns. The file is memory mapped, so only the current chunk is loaded.
+    """
+    catalog = np.load(filename, mmap_mode='r')
+    if catalog.dtype.names is not None:
+        time_column = 'lst' if 'lst' in catalog.dtype.names else 'jd'
+        names = ['ra', 'dec', time_column]
+    else:
+        time_column = 'jd'
+        names = [0, 1, 2]
+
+    for start in range(0, len(catalog), chunk_size):
+        chunk = catalog[start:start + chunk_size]
+        if catalog.dtype.names is not None:
+            columns = [chunk[name] for name in names]
+        else:
+            columns = [chunk[:, i] for i in names]
+        yield _to_chunk(*(columns + [time_column, longitude]))
+
+
+def solve_catalog(model, chunks, processes=None):
+    """
+    Solve chunks of (ra, dec, lst) arrays on a process pool, yielding the result arrays in input order.
+
+    At most two chunks per process are queued, so a large catalog is never read ahead into memory.
+    """
+    processes = processes or cpu_count()
+    pool = Pool(processes, initializer=_init_worker, initargs=(model,))
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_solve_chunk, (chunk,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Compute dome azimuths and slit windows for a catalog of pointings.')
+    parser.add_argument('catalog', help='CSV or .npy catalog with ra, dec (degrees) and jd or lst (hours) columns')
+    parser.add_argument('-o', '--output', help='output CSV file (default: standard output)')
+    parser.add_argument('--latitude', type=float, required=True, help='site latitude, in degrees')
+    parser.add_argument('--longitude', type=float, default=0., help='site east longitude, in degrees')
+    parser.add_argument('--geometry', choices=sorted(GEOMETRIES), help='dome geometry preset')
+    parser.add_argument('--dome-radius', type=float)
+    parser.add_argument('--mount-dec-height', type=float)
+    parser.add_argument('--mount-dec-length', type=float)
+    parser.add_argument('--mount-dec-offset', type=float)
+    parser.add_argument('--slit-width', type=float, help='slit width, in the same units as the dome radius')
+    parser.add_argument('--aperture', type=float, default=0., help='telescope aperture diameter')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='pointings per chunk')
+    args = parser.parse_args(args)
+
+    geometry = list(GEOMETRIES[args.geometry]) if args.geometry else [None] * 4
+    for i, name in enumerate(['dome_radius', 'mount_dec_height', 'mount_dec_length', 'mount_dec_offset']):
+        if getattr(args, name) is not None:
+            geometry[i] = getattr(args, name)
+    if None in geometry:
+        parser.error('the dome geometry needs --geometry or all of --dome-radius, --mount-dec-height, '
+                     '--mount-dec-length and --mount-dec-offset')
+
+    model = AzimuthModel(args.latitude, *geometry, slit_width=args.slit_width, aperture=args.aperture)
+
+    if args.catalog.endswith('.npy'):
+        chunks = read_npy(args.catalog, args.chunk_size, args.longitude)
+        fp = None
+    else:
+        fp = open(args.catalog)
+        chunks = read_csv(fp, args.chunk_size, args.longitude)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        out.write(','.join(OUTPUT_COLUMNS) + '\n')
+        for result in solve_catalog(model, chunks, args.processes):
+            np.savetxt(out, result, fmt='%.6f', delimiter=',')
+    finally:
+        if fp is not None:
+            fp.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import threading
+import time
+
+
+class CallTimeout(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def call_with_timeout(func, timeout):
+    """
+    Call func() in a separate thread and wait at most timeout seconds for it to return.
+
+    A call that times out is left running in its (daemon) thread, its result is discarded.
+    """
+    result = {}
+
+    def run():
+        try:
+            result['value'] = func()
+        except Exception as e:
+            result['error'] = e
+
+    worker = threading.Thread(target=run)
+    worker.daemon = True
+    worker.start()
+    worker.join(timeout)
+
+    if worker.is_alive():
+        raise CallTimeout('call did not return in %.1f s' % timeout)
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+class CircuitBreaker(object):
+    """
+    Guard calls to a remote dependency with a deadline and stop calling it while it is unhealthy.
+
+    After failure_threshold consecutive failures (errors or timeouts) the breaker opens and calls fail at once with
+    CircuitOpen. After reset_timeout seconds one trial call is let through (half-open): it closes the breaker again
+    if it succeeds and reopens it if it fails. Calls that may take long (e.g. a dome slew) should pass a short probe
+    call, which is then used as the trial instead of them, so that the other calls are not held back meanwhile.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, timeout=10., failure_threshold=3, reset_timeout=30.):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._consecutive_failures = 0
+
+        self._calls = 0
+        self._failures = 0
+        self._timeouts = 0
+        self._rejected = 0
+        self._total_time = 0.
+        self._max_time = 0.
+        self._last_time = None
+
+    def _allow(self, trial=True):
+        with self._lock:
+            if self._state == self.OPEN:
+                if not trial or time.time() - self._opened_at < self.reset_timeout:
+                    self._rejected += 1
+                    return False
+                self._state = self.HALF_OPEN
+            elif self._state == self.HALF_OPEN:
+                # a trial call is already in flight
+                self._rejected += 1
+                return False
+            return True
+
+    def _record(self, elapsed, error=None):
+        with self._lock:
+            self._calls += 1
+            self._total_time += elapsed
+            self._max_time = max(self._max_time, elapsed)
+            self._last_time = elapsed
+
+            if error is None:
+                self._consecutive_failures = 0
+                self._state = self.CLOSED
+                return
+
+            self._failures += 1
+            if isinstance(error, CallTimeout):
+                self._timeouts += 1
+            self._consecutive_failures += 1
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.time()
+
+    def _trial_due(self):
+        with self._lock:
+            return self._state == self.HALF_OPEN or \
+                (self._state == self.OPEN and time.time() - self._opened_at >= self.reset_timeout)
+
+    def call(self, func, timeout=None, probe=None):
+        if probe is not None and self._trial_due():
+            self.call(probe)
+
+        if not self._allow(trial=probe is None):
+            raise CircuitOpen('%s is unavailable, calls suspended' % self.name)
+
+        start = time.time()
+        try:
+            value = call_with_timeout(func, self.timeout if timeout is None else timeout)
+        except Exception as e:
+            self._record(time.time() - start, e)
+            raise
+        self._record(time.time() - start)
+        return value
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def status(self):
+        with self._lock:
+            return {'state': self._state,
+                    'opened_at': self._opened_at,
+                    'consecutive_failures': self._consecutive_failures,
+                    'calls': self._calls,
+                    'failures': self._failures,
+                    'timeouts': self._timeouts,
+                    'rejected': self._rejected,
+                    'last_time': self._last_time,
+                    'mean_time': self._total_time / self._calls if self._calls else None,
+                    'max_time': self._max_time}
@@ -0,0 +1,43 @@
+import threading
+import time
+
+
+class StatusCache(object):
+    """
+    Keep the last answer of each status query together with the time it was obtained.
+
+    An answer is fresh while it is younger than the time-to-live of its query (a time-to-live of zero disables
+    caching for the query). Invalidated or expired answers are still kept as the last known value.
+    """
+
+    def __init__(self, ttls):
+        self.ttls = dict(ttls)
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        """
+        Return the fresh cached answer for key or raise KeyError.
+        """
+        with self._lock:
+            value, timestamp = self._entries[key]
+        if timestamp is None or time.time() - timestamp >= self.ttls.get(key, 0):
+            raise KeyError(key)
+        return value
+
+    def last(self, key):
+        """
+        Return the last known answer for key, however old, or raise KeyError.
+        """
+        with self._lock:
+            return self._entries[key][0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys or list(self._entries):
+                if key in self._entries:
+                    self._entries[key] = (self._entries[key][0], None)
@@ -17,28 +17,98 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-# Iteratively solve for the azimuth of the dome given the telescope RA and Dec
-from math import pi, sin, cos, sqrt, atan2
+# Iteratively solve for the azimuth of the dome given the telescope hour angle and declination
+#
+# This module only depends on math and NumPy, so that it can be used without chimera (e.g. by batch tools and their
+# worker processes). Converting chimera positions to hour angle and declination is left to the DomeSync instrument.
+from __future__ import print_function
+
+from collections import namedtuple
+from math import pi, sin, cos, sqrt, atan2, radians
+
+import numpy as np
+
+# Rate of change of the local sidereal time, in radians per SI second
+SIDEREAL_RATE = 2 * pi / 86164.0905
+
+# Below this fraction of the dome radius the dome point is taken to be on the dome axis, where the azimuth is undefined
+AXIS_EPSILON = 1e-6
+
+# Prediction of the dome motion while the telescope tracks through (or near) the zenith.
+# Times are in seconds from the given hour angle, azimuths in degrees and the rate in degrees per second.
+ZenithPassage = namedtuple('ZenithPassage', ['singular', 'peak_rate', 'peak_time', 'start_time', 'end_time',
+                                             'center_az', 'half_width'])
+
+# Fractions of the telescope aperture vignetted by the dome: in total, and by the slit edges, the shutter at the top
+# of the slit and the dome wall below it. A ray blocked by more than one of them counts in each.
+Vignetting = namedtuple('Vignetting', ['total', 'slit', 'shutter', 'wall'])
+
+
+# Map an angle in degrees to  -180 <= angle < 180
+
+def map180(angle):
+    return (angle + 180.) % 360. - 180.
+
+
+# Dome geometries of the legacy dome_track script, in meters:
+# (dome_radius, mount_dec_height, mount_dec_length, mount_dec_offset)
+GEOMETRIES = {
+    'CDK20N': (1.75, 0.0, 0.6, 0.24),
+    'CDK20S': (1.75, 0.0, 0.6, 0.24),
+    'RC24': (2.83, -0.25, 0.0, 0.66),
+}
+
+
+# Local mean sidereal time, in radians, for Julian dates jd at the east longitude (in degrees)
+
+def local_sidereal_time(jd, longitude):
+    gmst = 280.46061837 + 360.98564736629 * (np.asarray(jd, dtype=float) - 2451545.0)
+    return np.radians((gmst + longitude) % 360.)
+
+
+# Convert hour angles and declinations to azimuths and altitudes, all in radians
+# Geographic azimuth convention is followed:
+#   Due north is zero and azimuth increases from north to east
 
-from chimera.core.site import Site
-from chimera.util.coord import CoordUtil, Coord
-from chimera.util.position import Position
+def equatorial_to_horizontal(ha, dec, latitude):
+    altitude = np.arcsin(np.sin(latitude) * np.sin(dec) + np.cos(latitude) * np.cos(dec) * np.cos(ha))
+    azimuth = np.arctan2(-np.cos(dec) * np.sin(ha),
+                         np.sin(dec) * np.cos(latitude) - np.sin(latitude) * np.cos(dec) * np.cos(ha))
+    return azimuth % (2 * pi), altitude
 
 
 class AzimuthModel(object):
-    def __init__(self, site_latitude, dome_radius, mount_dec_height, mount_dec_length, mount_dec_offset):
+    """
+    Dome geometry of a German equatorial mount inside a spherical dome.
+
+    The site latitude is in degrees and the lengths can be in any unit, as long as they all use the same one.
+    """
+
+    def __init__(self, site_latitude, dome_radius, mount_dec_height, mount_dec_length, mount_dec_offset,
+                 slit_width=None, aperture=0., slit_bottom=0., shutter_top=100.):
         self.site_latitude = site_latitude
+        self._latitude = radians(site_latitude)
         self.dome_radius = dome_radius
         self.mount_dec_height = mount_dec_height
         self.mount_dec_length = mount_dec_length
         self.mount_dec_offset = mount_dec_offset
+        self.slit_width = slit_width
+        self.aperture = aperture
+        # Altitudes, in degrees, of the lower and upper ends of the slit opening, measured along the slit from the
+        # horizon in front of it. shutter_top > 90 means that the slit opens past the zenith.
+        self.slit_bottom = slit_bottom
+        self.shutter_top = shutter_top
 
-    def solve_dome_azimuth(self, telescope_pos, lst, nloops=10):
+    @property
+    def slit_configured(self):
+        # Whether the slit and aperture are known, without them the vignetting is meaningless
+        return self.slit_width is not None and self.aperture > 0
+
+    def _solve_dome_point(self, ha, dec, nloops):
 
         # Find the altitude and azimuth of the current pointing
         # This should be valid in either hemisphere
-        pos = Position.raDecToAltAz(telescope_pos, self.site_latitude, lst)
-        telaz, telalt, ha = pos.az.R, pos.alt.R, CoordUtil.raToHa(telescope_pos.ra, lst).R
+        telaz, telalt = [float(c) for c in equatorial_to_horizontal(ha, dec, self._latitude)]
 
         # Find the reference point on the optical axis in dome coordinates
         # z: vertical
@@ -64,7 +134,7 @@ class AzimuthModel(object):
         phi = ha
 
         # Assign theta
-        theta = abs(self.site_latitude.R)
+        theta = abs(self._latitude)
 
         # Find the dome coordinates of the OTA reference point for a German equatorial
         # This works in either hemisphere
@@ -80,7 +150,8 @@ class AzimuthModel(object):
         d = 0.
         r = self.dome_radius
 
-        if self.site_latitude.R <= 0.:
+        telaz2, telalt2 = telaz, telalt
+        if self._latitude <= 0.:
             telaz2 = telaz - pi
             # between (0, 2pi):
             if telaz2 > 2 * pi:
@@ -88,8 +159,6 @@ class AzimuthModel(object):
             elif telaz2 < 0:
                 telaz2 += 2 * pi
 
-            telalt2 = telalt
-
         # Iterate for convergence
 
         n = 0
@@ -108,34 +177,228 @@ class AzimuthModel(object):
 
             n += 1
 
+        return x, y, z, telaz
+
+    def _dome_azimuth(self, x, y, telaz):
+
         # Use (x,y,0) from the interation to find the azimuth of the dome
         # Azimuth is N (0), E (90), S (180), W (270) in both hemispheres
         # However x and y are different in the hemispheres so we fix that here
 
-        zeta = atan2(x, y)
-        if (zeta > - 2. * pi) and (zeta < 2. * pi):
-            if self.site_latitude.R <= 0.:
-                zeta += pi
-        else:
+        # On the dome axis atan2 is singular, so fall back to the telescope azimuth
+        if sqrt(x * x + y * y) < AXIS_EPSILON * self.dome_radius:
             zeta = telaz
+        else:
+            zeta = atan2(x, y)
+            if self._latitude <= 0.:
+                zeta += pi
 
         if zeta < 0:
             zeta = zeta + 2 * pi
-        elif zeta > 2 * pi:
-            zeta - 2 * pi
+        elif zeta >= 2 * pi:
+            zeta = zeta - 2 * pi
 
         return zeta * 180 / pi
 
+    def solve_dome_azimuth(self, ha, dec, nloops=10):
+        """
+        Solve the dome azimuth, in degrees, for a pointing at hour angle ha and declination dec, in radians.
+        """
+        x, y, z, telaz = self._solve_dome_point(ha, dec, nloops)
+        return self._dome_azimuth(x, y, telaz)
 
-if __name__ == '__main__':
-    import numpy as np
+    def zenith_passage(self, ha, dec, window=600., step=10., zenith_limit=80., follow_rate=0., nloops=10):
+        """
+        Predict the dome azimuth motion while the telescope tracks dec from hour angle ha for the next window seconds.
+
+        Near the zenith a small pointing change can need a large dome rotation. The solution is sampled every step
+        seconds and the passage is singular when, with the point where the optical axis crosses the dome above
+        zenith_limit degrees, the dome azimuth changes faster than follow_rate degrees per second. The passage spans
+        from the first to the last of these fast steps, and center_az and half_width cover the dome azimuths visited
+        during it (or during the whole window, when it is not singular), so the dome can be parked at center_az
+        instead of chasing the target.
+
+        :param ha: Hour angle at the start of the prediction, in radians.
+        :param dec: Declination, in radians.
+        :param follow_rate: Fastest dome azimuth change that can be followed by tracking, in degrees per second.
+        :return: ZenithPassage
+        """
+        nsteps = max(int(window / step), 1)
+        azimuths, altitudes = [], []
+        for n in range(nsteps + 1):
+            x, y, z, telaz = self._solve_dome_point(ha + n * step * SIDEREAL_RATE, dec, nloops)
+            azimuths.append(self._dome_azimuth(x, y, telaz))
+            altitudes.append(atan2(z, sqrt(x * x + y * y)))
+
+        # Unwrap so that rates and spans are not fooled by the 0/360 crossing
+        unwrapped = [azimuths[0]]
+        for az in azimuths[1:]:
+            unwrapped.append(unwrapped[-1] + map180(az - unwrapped[-1]))
+
+        rates = [abs(b - a) / step for a, b in zip(unwrapped[:-1], unwrapped[1:])]
+        peak = max(range(nsteps), key=lambda n: rates[n])
+
+        # step n goes from sample n to sample n + 1
+        fast = [n for n in range(nsteps)
+                if rates[n] > follow_rate and max(altitudes[n], altitudes[n + 1]) >= radians(zenith_limit)]
+        singular = len(fast) > 0
+        first, last = (fast[0], fast[-1] + 1) if singular else (0, nsteps)
 
+        span = unwrapped[first:last + 1]
+        low, high = min(span), max(span)
+
+        return ZenithPassage(singular=singular, peak_rate=rates[peak], peak_time=(peak + 0.5) * step,
+                             start_time=first * step, end_time=last * step,
+                             center_az=((low + high) / 2.) % 360., half_width=(high - low) / 2.)
+
+    def _optical_axis_batch(self, ha, dec):
+        # Reference point (x0, y0, z0) and direction (ux, uy, uz) of the optical axis in dome coordinates,
+        # see _solve_dome_point for the conventions
+        latitude = self._latitude
+        telaz, telalt = equatorial_to_horizontal(ha, dec, latitude)
+
+        phi = ha
+        theta = abs(latitude)
+
+        x0 = self.mount_dec_length * np.sin(phi)
+        y0 = -self.mount_dec_length * np.cos(phi) * sin(theta) + self.mount_dec_offset
+        z0 = self.mount_dec_length * np.cos(phi) * cos(theta) + self.mount_dec_height
+
+        telaz2 = (telaz - pi) % (2 * pi) if latitude <= 0. else telaz
+        ux, uy, uz = np.cos(telalt) * np.sin(telaz2), np.cos(telalt) * np.cos(telaz2), np.sin(telalt)
+
+        return (x0, y0, z0), (ux, uy, uz), telaz
+
+    def _solve_dome_point_batch(self, ha, dec, nloops):
+        # Vectorized version of _solve_dome_point
+        (x0, y0, z0), (ux, uy, uz), telaz = self._optical_axis_batch(ha, dec)
+
+        d = np.zeros_like(x0)
+        r = np.full_like(x0, self.dome_radius)
+        for _ in range(nloops):
+            d -= r - self.dome_radius
+            rp = self.dome_radius + d
+            x = x0 + rp * ux
+            y = y0 + rp * uy
+            z = z0 + rp * uz
+            r = np.sqrt(x * x + y * y + z * z)
+
+        return x, y, z, telaz
+
+    def _dome_azimuth_batch(self, x, y, telaz):
+        zeta = np.arctan2(x, y)
+        if self._latitude <= 0.:
+            zeta += pi
+        zeta = np.where(np.hypot(x, y) < AXIS_EPSILON * self.dome_radius, telaz, zeta)
+        return np.degrees(zeta % (2 * pi))
+
+    def _slit_window_batch(self, x, y):
+        # Half width, in degrees, of the dome azimuths that keep the whole aperture inside the slit where the optical
+        # axis crosses the dome. It opens up to 180 degrees on the dome axis.
+        if self.slit_width is None:
+            return np.full_like(x, np.nan)
+        clearance = (self.slit_width - self.aperture) / 2.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = clearance / np.hypot(x, y)
+        return np.where(ratio >= 1, 180., np.degrees(np.arcsin(np.clip(ratio, 0., 1.))))
+
+    def solve_dome_azimuth_batch(self, ha, dec, nloops=10):
+        """
+        Solve the dome azimuth for many pointings at once.
+
+        :param ha: Hour angles, in radians.
+        :param dec: Declinations, in radians.
+        :return: (dome azimuths, slit window half widths), in degrees. The window is NaN when slit_width is not set.
+        """
+        x, y, z, telaz = self._solve_dome_point_batch(np.asarray(ha, dtype=float), np.asarray(dec, dtype=float),
+                                                      nloops)
+        return self._dome_azimuth_batch(x, y, telaz), self._slit_window_batch(x, y)
+
+    def solve_dome_azimuth_closed_batch(self, ha, dec):
+        """
+        Solve the dome azimuth for many pointings at once, intersecting the optical axis with the dome sphere in
+        closed form instead of iterating.
+
+        :param ha: Hour angles, in radians.
+        :param dec: Declinations, in radians.
+        :return: (dome azimuths, slit window half widths), in degrees, as solve_dome_azimuth_batch.
+        """
+        (x0, y0, z0), (ux, uy, uz), telaz = self._optical_axis_batch(np.asarray(ha, dtype=float),
+                                                                     np.asarray(dec, dtype=float))
+        pu = x0 * ux + y0 * uy + z0 * uz
+        t = -pu + np.sqrt(np.maximum(pu * pu - (x0 * x0 + y0 * y0 + z0 * z0) + self.dome_radius ** 2, 0.))
+        x, y = x0 + t * ux, y0 + t * uy
+        return self._dome_azimuth_batch(x, y, telaz), self._slit_window_batch(x, y)
+
+    def vignetting_batch(self, ha, dec, dome_az, samples=16):
+        """
+        Trace rays parallel to the optical axis over the telescope aperture up to the dome and count the ones that
+        the dome blocks.
+
+        The aperture is sampled by the points of a samples x samples grid that fall inside it. Each ray is
+        intersected with the dome sphere: it is blocked by the slit edges when it hits the dome farther than half
+        the slit width from the slit center line, by the shutter when it hits it above shutter_top and by the wall
+        when it hits it below slit_bottom. The slit edges are ignored when slit_width is not set.
+
+        Memory use grows as len(ha) * samples ** 2, so split very large batches.
+
+        :param ha: Hour angles, in radians.
+        :param dec: Declinations, in radians.
+        :param dome_az: Dome azimuths, in degrees.
+        :return: Vignetting of arrays with the shape of the broadcast inputs.
+        """
+        ha, dec, dome_az = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in (ha, dec, dome_az)])
+        shape = ha.shape
+        ha, dec, dome_az = ha.ravel(), dec.ravel(), dome_az.ravel()
+
+        p0, u, telaz = self._optical_axis_batch(ha, dec)
+        p0, u = np.stack(p0, axis=-1), np.stack(u, axis=-1)
+
+        # Aperture basis: e1 horizontal and perpendicular to the optical axis, e2 completing it
+        e1 = np.cross([0., 0., 1.], u)
+        norm = np.linalg.norm(e1, axis=-1)
+        e1 = np.where(norm[:, None] > AXIS_EPSILON, e1 / np.maximum(norm, AXIS_EPSILON)[:, None], [1., 0., 0.])
+        e2 = np.cross(u, e1)
+
+        grid = (np.arange(samples) + 0.5) / samples * 2. - 1.
+        a, b = [g.ravel() for g in np.meshgrid(grid, grid)]
+        inside = a * a + b * b <= 1.
+        a, b = a[inside] * self.aperture / 2., b[inside] * self.aperture / 2.
+
+        # Ray origins (pointings, rays, xyz) and their intersection with the dome sphere
+        origins = p0[:, None, :] + a[None, :, None] * e1[:, None, :] + b[None, :, None] * e2[:, None, :]
+        ou = np.einsum('nmk,nk->nm', origins, u)
+        t = -ou + np.sqrt(np.maximum(ou * ou - (origins * origins).sum(axis=-1) + self.dome_radius ** 2, 0.))
+        hits = origins + t[..., None] * u[:, None, :]
+
+        # Position of the hits relative to the slit, in the same frame
+        zeta = np.radians(dome_az) - (pi if self._latitude <= 0. else 0.)
+        along = hits[..., 0] * np.sin(zeta)[:, None] + hits[..., 1] * np.cos(zeta)[:, None]
+        across = hits[..., 0] * np.cos(zeta)[:, None] - hits[..., 1] * np.sin(zeta)[:, None]
+        arc = np.degrees(np.arctan2(hits[..., 2], along))
+
+        slit = np.zeros_like(across, dtype=bool) if self.slit_width is None else np.abs(across) > self.slit_width / 2.
+        shutter = arc > self.shutter_top
+        wall = arc < self.slit_bottom
+
+        return Vignetting(total=(slit | shutter | wall).mean(axis=-1).reshape(shape),
+                          slit=slit.mean(axis=-1).reshape(shape),
+                          shutter=shutter.mean(axis=-1).reshape(shape),
+                          wall=wall.mean(axis=-1).reshape(shape))
+
+    def vignetting(self, ha, dec, dome_az, samples=16):
+        """
+        Fractions of the aperture vignetted by the dome for a single pointing, see vignetting_batch.
+        """
+        return Vignetting(*[float(f) for f in self.vignetting_batch(ha, dec, dome_az, samples)])
+
+
+if __name__ == '__main__':
     dome_radius, mount_dec_height, mount_dec_length, mount_dec_offset = 147, 0, 49.2, 0
-    site = Site()
-    Model = AzimuthModel(site['latitude'], dome_radius, mount_dec_height, mount_dec_length, mount_dec_offset)
-    # for dra in np.arange(10, 200, 36):
-    #     for ddec in np.arange(1, 360, 10):
-    for az, alt in [(ii, jj) for ii in np.arange(5, 360, 10) for jj in np.arange(25, 90, 20)]:
-        tel_pos = Position.altAzToRaDec(Position.fromAltAz(Coord.fromD(alt), Coord.fromD(az)), site['latitude'], site.LST())
-        model = Model.solve_dome_azimuth(tel_pos, site.LST_inRads())
-        print 'here', alt, az, model, model - az
+    site_latitude = -22.5
+    Model = AzimuthModel(site_latitude, dome_radius, mount_dec_height, mount_dec_length, mount_dec_offset)
+    for ha, dec in [(ii, jj) for ii in np.arange(-6, 6.5, 1) for jj in np.arange(-80, 30, 20)]:
+        ha, dec = np.radians(ha * 15.), np.radians(dec)
+        az, alt = np.degrees(equatorial_to_horizontal(ha, dec, np.radians(site_latitude)))
+        model = Model.solve_dome_azimuth(ha, dec)
+        print('here', alt, az, model, map180(model - az))
@@ -0,0 +1,155 @@
+import threading
+from math import sqrt
+
+from chimera_domesync.util.dome_track import map180
+
+
+class DomeKinematics(object):
+    """
+    Estimate the dome rotation rate and acceleration from azimuth samples taken during slews.
+
+    The dome is modelled with a trapezoidal velocity profile: it accelerates at a constant rate up to its cruise rate,
+    and decelerates symmetrically at the end of the slew. Each finished slew updates the estimates with exponential
+    smoothing, so they follow slow changes such as the dome getting slower in the cold. The acceleration also absorbs
+    the command latency, since the time is counted from the moment the slew was requested.
+
+    :param rate: Initial rotation rate, in degrees per second.
+    :param acceleration: Initial acceleration, in degrees per second squared, or None for an instantaneous start.
+    :param smoothing: Weight of the newest slew in the estimates, between 0 and 1.
+    """
+
+    # Fewest samples a cruise is fitted over
+    MIN_CRUISE_SAMPLES = 3
+
+    # Fits of the cruise made before the slew is taken to have none
+    CRUISE_ITERATIONS = 5
+
+    # Estimates outside these bounds, in degrees per second and degrees per second squared, are discarded
+    RATE_LIMITS = (0.05, 30.)
+    ACCELERATION_LIMITS = (0.01, 20.)
+
+    def __init__(self, rate=2.5, acceleration=None, smoothing=0.3):
+        self.rate = rate
+        self.acceleration = acceleration
+        self.smoothing = smoothing
+        self.slews = 0
+
+        self._lock = threading.Lock()
+        self._samples = None
+
+    def begin_slew(self, t, az):
+        with self._lock:
+            self._samples = [(t, 0.)]
+            self._last_az = az
+
+    def add_sample(self, t, az):
+        with self._lock:
+            if self._samples is None:
+                return
+            # accumulate the distance travelled, unwrapping across 0/360
+            self._samples.append((t, self._samples[-1][1] + abs(map180(az - self._last_az))))
+            self._last_az = az
+
+    def end_slew(self):
+        with self._lock:
+            samples, self._samples = self._samples, None
+        if samples is None:
+            return
+
+        # drop the samples taken after the dome stopped
+        while len(samples) > 2 and samples[-1][1] == samples[-2][1]:
+            samples.pop()
+        if len(samples) < 3 or samples[-1][1] == 0:
+            return
+
+        t0, distance = samples[0][0], samples[-1][1]
+        intervals = sorted(tb - ta for (ta, sa), (tb, sb) in zip(samples[:-1], samples[1:]))
+        interval = intervals[len(intervals) // 2]
+        if interval <= 0:
+            return
+
+        cruise = self._cruise(samples, interval)
+        duration = samples[-1][0] - t0
+        if cruise is not None:
+            rate, ramp = cruise
+            # the ramp must be resolved by the samples to tell anything about the acceleration
+            acceleration = rate / ramp if ramp >= interval else None
+        elif duration < 2 * interval:
+            rate = acceleration = None
+        elif 2. * distance / duration <= self.rate:
+            # too short to reach the cruise rate: accelerate for half of the slew and decelerate for the other half
+            rate = None
+            acceleration = 4. * distance / duration ** 2
+        else:
+            # too short to fit the cruise but faster than a triangle: the ramps take what the cruise rate leaves.
+            # The end of the slew is only known to a sample interval, so shorter ramps are not resolved.
+            rate = None
+            ramp = duration - distance / self.rate
+            acceleration = self.rate / ramp if ramp >= 2 * interval else None
+
+        if rate is not None and not self.RATE_LIMITS[0] <= rate <= self.RATE_LIMITS[1]:
+            rate = None
+        if acceleration is not None and not self.ACCELERATION_LIMITS[0] <= acceleration <= self.ACCELERATION_LIMITS[1]:
+            acceleration = None
+
+        with self._lock:
+            if rate is not None:
+                self.rate += self.smoothing * (rate - self.rate)
+            if acceleration is not None:
+                if self.acceleration is None:
+                    self.acceleration = acceleration
+                else:
+                    self.acceleration += self.smoothing * (acceleration - self.acceleration)
+            self.slews += 1
+
+    def _cruise(self, samples, interval):
+        # Fit a line to the distance against time over the part of the slew between the ramps. Its slope is the cruise
+        # rate, and it crosses zero distance half a ramp after the slew started, so the ramp covers rate * that time.
+        # The samples are quantized by the encoder and irregular in time, so a fit over many of them is much steadier
+        # than the velocities between consecutive ones. The ramps are not known beforehand: the first fit is over the
+        # middle half of the distance, and each fit moves the segment past the ramps it finds. Fits over a cruise
+        # find ramps outside their segment, while fits around the peak of a triangular slew never do.
+        # Returns (rate, ramp time) or None when there is no cruise.
+        t0, distance = samples[0][0], samples[-1][1]
+        rate, ramp = self.rate, distance / 4.
+        for i in range(self.CRUISE_ITERATIONS):
+            # keep a sample interval away from the ramps
+            low, high = ramp + rate * interval, distance - ramp - rate * interval
+            segment = [(t, s) for t, s in samples if low <= s <= high]
+            if len(segment) < self.MIN_CRUISE_SAMPLES or \
+                    segment[-1][0] - segment[0][0] < (self.MIN_CRUISE_SAMPLES - 1) * interval:
+                return None
+            rate, start = _fit_line(segment)
+            if rate <= 0:
+                return None
+            ramp = max(rate * (start - t0), 0.)
+            if ramp <= low:
+                return rate, 2. * (start - t0)
+        return None
+
+    def slew_time(self, distance):
+        """
+        Predict how many seconds a slew of distance degrees takes.
+        """
+        distance = abs(distance)
+        rate, acceleration = self.rate, self.acceleration
+        if not acceleration:
+            return distance / rate
+        if distance >= rate * rate / acceleration:
+            return distance / rate + rate / acceleration
+        return 2. * sqrt(distance / acceleration)
+
+    def status(self):
+        return {'rate': self.rate, 'acceleration': self.acceleration, 'slews': self.slews}
+
+
+def _fit_line(points):
+    # Least squares fit of s = rate * (t - start) to (t, s) points, returns (rate, start)
+    n = float(len(points))
+    mean_t = sum(t for t, s in points) / n
+    mean_s = sum(s for t, s in points) / n
+    var_t = sum((t - mean_t) ** 2 for t, s in points)
+    if var_t <= 0:
+        return 0., mean_t
+    rate = sum((t - mean_t) * (s - mean_s) for t, s in points) / var_t
+    return rate, (mean_t - mean_s / rate if rate else mean_t)
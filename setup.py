@@ -4,7 +4,7 @@ setup(
     name='chimera_domesync',
     version='0.0.1',
     packages=['chimera_domesync', 'chimera_domesync.util', 'chimera_domesync.instruments'],
-    scripts=[],
+    scripts=['scripts/chimera-domesync-batch', 'scripts/chimera-domesync-accuracy'],
     url='http://github.com/astroufsc/chimera-domesync',
     license='GPL v2',
     author='William Schoenell',
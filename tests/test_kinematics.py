@@ -0,0 +1,69 @@
+import random
+from math import sqrt
+
+from chimera_domesync.util.kinematics import DomeKinematics
+
+
+def trapezoid(distance, rate, acceleration):
+    # Distance covered t seconds after the start of a slew with a trapezoidal (or triangular) velocity profile, and
+    # the duration of the slew
+    if acceleration is None:
+        return lambda t: min(max(t, 0.) * rate, distance), distance / rate
+    peak = min(rate, sqrt(acceleration * distance))
+    ramp = peak / acceleration
+    duration = ramp + distance / peak
+
+    def position(t):
+        if t <= 0:
+            return 0.
+        if t < ramp:
+            return acceleration * t * t / 2.
+        if t < duration - ramp:
+            return peak * ramp / 2. + peak * (t - ramp)
+        if t < duration:
+            return distance - acceleration * (duration - t) ** 2 / 2.
+        return distance
+    return position, duration
+
+
+def slew(kinematics, distance, rate, acceleration, period=0.5, jitter=0.05, resolution=1., rng=random):
+    # Sample a slew like DomeSync does: irregular times, azimuths quantized by the encoder, until the dome stops
+    position, duration = trapezoid(distance, rate, acceleration)
+    quantize = lambda s: round(s / resolution) * resolution
+    kinematics.begin_slew(0., 0.)
+    t = 0.
+    while t < duration + 2 * period:
+        t += period + rng.uniform(0., jitter)
+        kinematics.add_sample(t, quantize(position(t)))
+    kinematics.end_slew()
+
+
+def test_cruise_from_quantized_jittered_samples():
+    rng = random.Random(1)
+    for period, jitter, resolution in ((0.52, 0.08, 0.5), (0.5, 0.05, 1.), (0.52, 0.08, 1.)):
+        kinematics = DomeKinematics(rate=2.5)
+        for i in range(8):
+            slew(kinematics, 120., 2., 0.5, period, jitter, resolution, rng)
+        assert abs(kinematics.rate - 2.) < 0.05
+        assert abs(kinematics.acceleration - 0.5) < 0.1
+        true_time = 120. / 2. + 2. / 0.5
+        assert abs(kinematics.slew_time(120.) - true_time) < 1.
+
+
+def test_constant_rate_dome():
+    rng = random.Random(2)
+    kinematics = DomeKinematics(rate=2.5)
+    for distance in (30., 60., 90., 45., 120., 60.):
+        slew(kinematics, distance, 3., None, rng=rng)
+    assert abs(kinematics.rate - 3.) < 0.1
+    assert kinematics.acceleration is None or kinematics.acceleration > 3.
+
+
+def test_triangular_slews_keep_the_rate():
+    rng = random.Random(3)
+    kinematics = DomeKinematics(rate=2., acceleration=0.5)
+    for i in range(5):
+        slew(kinematics, 6., 2., 0.5, rng=rng)
+    assert kinematics.rate == 2.
+    # the end of a short slew is only known to the encoder resolution
+    assert abs(kinematics.acceleration - 0.5) < 0.25